@@ -3,10 +3,41 @@ Script to fetch the best performing model from MLflow Model Registry.
 This script is used in the CD pipeline to get the latest/best model.
 """
 import os
+import json
+import time
 import mlflow
 import sys
 from pathlib import Path
 
+# Snapshot of the last best-run lookup, reused for BEST_RUN_CACHE_TTL seconds to skip search_runs
+BEST_RUN_CACHE_PATH = Path(os.getenv("BEST_RUN_CACHE_PATH", ".cache/best_run.json"))
+BEST_RUN_CACHE_TTL = float(os.getenv("BEST_RUN_CACHE_TTL", "300"))
+
+def read_best_run_cache(key):
+    """Return the cached lookup for key if it is younger than BEST_RUN_CACHE_TTL, else None."""
+    try:
+        cached = json.loads(BEST_RUN_CACHE_PATH.read_text())
+    except (OSError, ValueError):
+        return None
+    if cached.get("key") != key or time.time() - cached.get("fetched_at", 0) >= BEST_RUN_CACHE_TTL:
+        return None
+    return cached
+
+def write_best_run_cache(key, run_id, metric_value):
+    """Store a best-run lookup (temp file + rename, so concurrent readers see old or new)."""
+    try:
+        BEST_RUN_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = f"{BEST_RUN_CACHE_PATH}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({"key": key, "run_id": run_id, "metric_value": metric_value, "fetched_at": time.time()}, f)
+        os.replace(tmp_path, BEST_RUN_CACHE_PATH)
+    except OSError as e:
+        print(f"⚠ Could not cache best run: {str(e)}")
+
+def invalidate_best_run_cache():
+    """Forget the cached best run, e.g. after logging a new training run."""
+    BEST_RUN_CACHE_PATH.unlink(missing_ok=True)
+
 def get_best_model_run_id(experiment_name="exchange_rate_forecasting", metric="rmse", ascending=True):
     """
     Fetch the best model run ID from MLflow based on a metric.
@@ -27,6 +58,14 @@ def get_best_model_run_id(experiment_name="exchange_rate_forecasting", metric="r
     os.environ['MLFLOW_TRACKING_USERNAME'] = os.getenv('DAGSHUB_USERNAME', os.getenv('MLFLOW_TRACKING_USERNAME', ''))
     os.environ['MLFLOW_TRACKING_PASSWORD'] = os.getenv('DAGSHUB_TOKEN', os.getenv('MLFLOW_TRACKING_PASSWORD', ''))
     
+    cache_key = [tracking_uri, experiment_name, metric, ascending]
+    cached = read_best_run_cache(cache_key)
+    if cached is not None:
+        print("Best model found (cached lookup):")
+        print(f"  Run ID: {cached['run_id']}")
+        print(f"  {metric}: {cached['metric_value']}")
+        return cached['run_id'], cached['metric_value']
+    
     try:
         # Get experiment
         experiment = mlflow.get_experiment_by_name(experiment_name)
@@ -53,13 +92,132 @@ def get_best_model_run_id(experiment_name="exchange_rate_forecasting", metric="r
         print(f"  Run ID: {run_id}")
         print(f"  {metric}: {metric_value}")
         
+        write_best_run_cache(cache_key, run_id, float(metric_value))
         return run_id, metric_value
         
     except Exception as e:
         print(f"Error fetching model: {str(e)}")
         sys.exit(1)
 
-def download_model(run_id, model_name="rf_model.pkl", output_dir="/app/models"):
+def copy_atomic(src, dst):
+    """Copy src to dst via a temporary file, so readers never see a partial copy."""
+    import shutil
+    tmp_path = f"{dst}.{os.getpid()}.tmp"
+    shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+def run_id_sidecar(local_path):
+    """Path of the file recording which MLflow run local_path was downloaded from."""
+    return Path(f"{local_path}.run_id")
+
+def write_run_id_sidecar(local_path, run_id):
+    """Record the MLflow run local_path was downloaded from."""
+    run_id_sidecar(local_path).write_text(run_id)
+
+def list_run_artifacts(run_id):
+    """List the top-level artifacts of a run, or None if the tracking server can't be reached."""
+    try:
+        return mlflow.artifacts.list_artifacts(run_id=run_id)
+    except Exception as e:
+        print(f"⚠ Could not list artifacts of run {run_id}: {str(e)}")
+        return None
+
+def cached_artifact_is_current(local_path, run_id, artifact_path, artifacts=None):
+    """
+    Check whether a local artifact copy can be used instead of downloading it again.
+    
+    Args:
+        local_path: Local copy of the artifact
+        run_id: MLflow run ID the artifact should come from
+        artifact_path: Artifact path within the run (e.g. rf_model.pkl)
+        artifacts: Result of list_run_artifacts, to avoid listing the run again
+    
+    Returns:
+        True if the sidecar records run_id and the local size matches the logged artifact
+    """
+    local_path = Path(local_path)
+    sidecar = run_id_sidecar(local_path)
+    if not local_path.exists() or not sidecar.exists():
+        return False
+    if sidecar.read_text().strip() != run_id:
+        return False
+    
+    # Run artifacts are immutable; the size check catches truncated or replaced local copies
+    if artifacts is None:
+        artifacts = list_run_artifacts(run_id)
+    if artifacts is None:
+        print(f"⚠ Using local copy of {artifact_path} without size check")
+        return True
+    
+    for artifact in artifacts:
+        if artifact.path == artifact_path:
+            return artifact.file_size is None or artifact.file_size == local_path.stat().st_size
+    return False
+
+def download_artifact(run_id, artifact_path, output_dir, artifacts=None, output_path=None):
+    """
+    Download one run artifact into output_dir (or to output_path), reusing a current local copy.
+    
+    Returns:
+        Path of the local copy
+    """
+    output_path = Path(output_path) if output_path else Path(output_dir) / artifact_path
+    
+    if cached_artifact_is_current(output_path, run_id, artifact_path, artifacts):
+        print(f"{artifact_path} from run {run_id} already at {output_path}, skipping download")
+        return output_path
+    
+    artifact_uri = f"runs:/{run_id}/{artifact_path}"
+    print(f"Downloading artifact from: {artifact_uri}")
+    
+    # Download artifact
+    local_path = mlflow.artifacts.download_artifacts(artifact_uri=artifact_uri)
+    
+    # Copy to output directory; the old sidecar goes first so it never vouches for the new file
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    run_id_sidecar(output_path).unlink(missing_ok=True)
+    copy_atomic(local_path, output_path)
+    write_run_id_sidecar(output_path, run_id)
+    return output_path
+
+def download_run_artifacts(run_id, artifact_paths, output_dir, max_workers=8, output_paths=None):
+    """
+    Download several artifacts of a run concurrently.
+    
+    Each download is a separate HTTP round trip to the artifact store, so they run
+    in a bounded thread pool instead of one after another.
+    
+    Args:
+        run_id: MLflow run ID
+        artifact_paths: Artifact paths within the run
+        output_dir: Directory to save the artifacts
+        max_workers: Maximum number of concurrent downloads
+        output_paths: Optional dict of artifact path -> local path, overriding output_dir
+    
+    Returns:
+        Dict of artifact path -> local path, for the artifacts present in the run
+    """
+    # One listing serves both the existence check and every cache check
+    artifacts = list_run_artifacts(run_id)
+    if artifacts is not None:
+        logged = {artifact.path for artifact in artifacts}
+        missing = [path for path in artifact_paths if path not in logged]
+        if missing:
+            print(f"⚠ Run {run_id} has no artifacts {missing}, skipping them")
+        artifact_paths = [path for path in artifact_paths if path in logged]
+    
+    output_paths = output_paths or {}
+    
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(artifact_paths)))) as executor:
+        local_paths = list(executor.map(
+            lambda path: download_artifact(run_id, path, output_dir, artifacts, output_paths.get(path)),
+            artifact_paths
+        ))
+    
+    return dict(zip(artifact_paths, local_paths))
+
+def download_model(run_id, model_name="rf_model.pkl", output_dir="/app/models", extra_artifacts=()):
     """
     Download model artifact from MLflow run.
     
@@ -67,20 +225,14 @@ def download_model(run_id, model_name="rf_model.pkl", output_dir="/app/models"):
         run_id: MLflow run ID
         model_name: Name of the model file
         output_dir: Directory to save the model
+        extra_artifacts: Other artifacts of the run to download alongside the model
+                         (e.g. training_stats.json); skipped if the run doesn't have them
     """
     try:
-        model_uri = f"runs:/{run_id}/{model_name}"
-        print(f"Downloading model from: {model_uri}")
-        
-        # Download artifact
-        local_path = mlflow.artifacts.download_artifacts(artifact_uri=model_uri)
-        
-        # Copy to output directory
-        output_path = Path(output_dir) / model_name
-        output_path.parent.mkdir(parents=True, exist_ok=True)
-        
-        import shutil
-        shutil.copy2(local_path, str(output_path))
+        local_paths = download_run_artifacts(run_id, [model_name, *extra_artifacts], output_dir)
+        if model_name not in local_paths:
+            raise FileNotFoundError(f"Run {run_id} has no artifact {model_name}")
+        output_path = local_paths[model_name]
         
         # Return normalized path (use forward slashes for cross-platform compatibility)
         normalized_path = str(output_path).replace('\\', '/')
@@ -96,7 +248,7 @@ if __name__ == "__main__":
     run_id, metric_value = get_best_model_run_id()
     
     # Download model
-    model_path = download_model(run_id)
+    model_path = download_model(run_id, extra_artifacts=("rf_model.npz", "training_stats.json"))
     
     # Output run ID for use in service
     print(f"\nMLFLOW_RUN_ID={run_id}")
@@ -3,29 +3,24 @@ Generate training statistics for drift detection without MLflow dependency.
 This script loads the data, creates features, and saves statistics.
 """
 import os
+import numpy as np
 import pandas as pd
 import json
 from datetime import datetime
 from pathlib import Path
 
-DATA_PATH = "data/processed/exchange_rates.csv"
+DATA_PATH = "data/processed/exchange_rates.parquet"
 TARGET_COL = "EUR"
 TIMESTAMP_COL = "collection_datetime"
 
 def load_data():
     """Load and prepare data."""
-    try:
-        df = pd.read_csv(DATA_PATH, on_bad_lines='skip')
-    except TypeError:
-        df = pd.read_csv(DATA_PATH, error_bad_lines=False, warn_bad_lines=False)
+    df = pd.read_parquet(DATA_PATH, engine="pyarrow", columns=[TIMESTAMP_COL, TARGET_COL])
     
     if df.empty:
         raise ValueError(f"Data file {DATA_PATH} is empty.")
     
-    essential_cols = [TIMESTAMP_COL, TARGET_COL]
-    df = df[[col for col in essential_cols if col in df.columns]]
-    
-    df[TIMESTAMP_COL] = pd.to_datetime(df[TIMESTAMP_COL], errors='coerce')
+    df[TARGET_COL] = df[TARGET_COL].astype("float32")
     df = df.dropna(subset=[TIMESTAMP_COL, TARGET_COL])
     df = df.sort_values(TIMESTAMP_COL)
     
@@ -41,17 +36,17 @@ def create_lags(df, n_lags=3):
     if len(df) < min_required_rows:
         raise ValueError(f"Insufficient data! Need at least {min_required_rows} rows.")
     
-    # Create lag features
-    for lag in range(1, n_lags + 1):
-        df[f"lag_{lag}"] = df[TARGET_COL].shift(lag)
-    
-    df = df.dropna()
-    
-    if len(df) == 0:
-        raise ValueError("No valid data after creating lags.")
+    # Create lag features from sliding windows over the target (no NaN rows to drop):
+    # row i holds [t-n_lags, ..., t-1, t], reversed so that lag_1 comes first
+    values = df[TARGET_COL].to_numpy()
+    windows = np.lib.stride_tricks.sliding_window_view(values, n_lags + 1)
     
-    X = df[[f"lag_{i}" for i in range(1, n_lags + 1)]]
-    y = df[TARGET_COL]
+    X = pd.DataFrame(
+        windows[:, -2::-1],
+        columns=[f"lag_{i}" for i in range(1, n_lags + 1)],
+        index=df.index[n_lags:]
+    )
+    y = df[TARGET_COL].iloc[n_lags:]
     
     return X, y
 
@@ -71,13 +66,9 @@ def generate_stats():
         "timestamp": datetime.now().isoformat()
     }
     
-    for col in X.columns:
-        training_stats["features"][col] = {
-            "min": float(X[col].min()),
-            "max": float(X[col].max()),
-            "mean": float(X[col].mean()),
-            "std": float(X[col].std())
-        }
+    # One aggregation over the whole frame instead of four reductions per column
+    stats_df = X.agg(["min", "max", "mean", "std"]).astype(float)
+    training_stats["features"] = {col: stats_df[col].to_dict() for col in X.columns}
     
     # Save to models directory
     Path("models").mkdir(exist_ok=True)
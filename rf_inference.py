@@ -0,0 +1,130 @@
+"""
+Random forest inference without scikit-learn's per-tree Python dispatch.
+
+The fitted trees are flattened into padded (n_trees, max_nodes) arrays and walked
+in a single compiled loop, which is far cheaper than RandomForestRegressor.predict
+for the single-row requests served by service.py.
+"""
+import os
+
+import numpy as np
+
+# Numba is optional: without it the same traversal runs as plain Python
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Compact dtypes for traversal: halves the memory traffic of sklearn's int64/float64 node arrays
+TREE_DTYPES = {
+    'feature': np.int32,
+    'threshold': np.float32,
+    'children_left': np.int32,
+    'children_right': np.int32,
+    'value': np.float32,
+}
+TREE_ARRAYS = tuple(TREE_DTYPES)
+
+def _float32_thresholds(threshold):
+    """
+    Round split thresholds down to float32.
+
+    Inputs are float32, so x <= t holds exactly when x <= (largest float32 <= t);
+    rounding to nearest could move t onto the next input value and flip the split.
+    """
+    rounded = threshold.astype(np.float32)
+    too_high = rounded > threshold
+    rounded[too_high] = np.nextafter(rounded[too_high], np.float32(-np.inf))
+    return rounded
+
+def extract_tree_arrays(model):
+    """
+    Stack the node arrays of every tree in a fitted RandomForestRegressor.
+
+    Trees are padded to the largest node count; padded slots are never reached
+    because traversal stops at leaves (children_left == -1).
+    """
+    trees = [estimator.tree_ for estimator in model.estimators_]
+    n_trees = len(trees)
+    max_nodes = max(tree.node_count for tree in trees)
+
+    arrays = {
+        'feature': np.full((n_trees, max_nodes), -2, dtype=TREE_DTYPES['feature']),
+        'threshold': np.zeros((n_trees, max_nodes), dtype=TREE_DTYPES['threshold']),
+        'children_left': np.full((n_trees, max_nodes), -1, dtype=TREE_DTYPES['children_left']),
+        'children_right': np.full((n_trees, max_nodes), -1, dtype=TREE_DTYPES['children_right']),
+        'value': np.zeros((n_trees, max_nodes), dtype=TREE_DTYPES['value']),
+    }
+    for i, tree in enumerate(trees):
+        n_nodes = tree.node_count
+        arrays['feature'][i, :n_nodes] = tree.feature
+        arrays['threshold'][i, :n_nodes] = _float32_thresholds(tree.threshold)
+        arrays['children_left'][i, :n_nodes] = tree.children_left
+        arrays['children_right'][i, :n_nodes] = tree.children_right
+        arrays['value'][i, :n_nodes] = tree.value[:, 0, 0]  # single-output regressor
+
+    return arrays
+
+def save_tree_arrays(path, arrays):
+    """
+    Write stacked tree arrays to an uncompressed .npz archive.
+
+    Written to a temporary file and renamed, so concurrent service workers never
+    read a partially written archive.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"  # np.savez would append .npz to other names
+    np.savez(tmp_path, **{name: arrays[name] for name in TREE_ARRAYS})
+    os.replace(tmp_path, path)
+
+def load_tree_arrays(path):
+    """Load tree arrays written by save_tree_arrays (no scikit-learn unpickling)."""
+    with np.load(path) as archive:
+        arrays = {name: archive[name] for name in TREE_ARRAYS}
+
+    # Archives written before the compact dtypes are converted on load
+    if arrays['threshold'].dtype != TREE_DTYPES['threshold']:
+        arrays['threshold'] = _float32_thresholds(arrays['threshold'])
+    return {name: arrays[name].astype(dtype, copy=False) for name, dtype in TREE_DTYPES.items()}
+
+def _predict_trees(X, feature, threshold, children_left, children_right, value):
+    """Average the leaf values reached by each row of X across all trees."""
+    n_samples = X.shape[0]
+    n_trees = feature.shape[0]
+    out = np.empty(n_samples, dtype=np.float64)
+
+    for s in range(n_samples):
+        total = 0.0
+        for t in range(n_trees):
+            node = 0
+            while children_left[t, node] != -1:
+                if X[s, feature[t, node]] <= threshold[t, node]:
+                    node = children_left[t, node]
+                else:
+                    node = children_right[t, node]
+            total += value[t, node]
+        out[s] = total / n_trees
+
+    return out
+
+if njit is not None:
+    _predict_trees = njit(cache=True)(_predict_trees)
+
+def predict_trees(X, arrays):
+    """
+    Predict with the stacked tree arrays from extract_tree_arrays.
+
+    X is a 2-D (n_samples, n_features) array. It is compared as float32, the same
+    dtype scikit-learn casts inputs to before walking its trees, so every row reaches
+    the same leaves as in RandomForestRegressor.predict. Leaf values are float32, which
+    leaves predictions within float32 rounding of scikit-learn's (the average itself
+    is accumulated in float64).
+    """
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    return _predict_trees(
+        X,
+        arrays['feature'],
+        arrays['threshold'],
+        arrays['children_left'],
+        arrays['children_right'],
+        arrays['value'],
+    )
@@ -1,15 +1,24 @@
 from fastapi import FastAPI, HTTPException, Request
-from pydantic import BaseModel
+from fastapi.exception_handlers import request_validation_exception_handler
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse, Response
+from pydantic import BaseModel, conlist, field_validator
+import asyncio
 import mlflow
 import joblib
+import numpy as np
+import orjson
 import os
 import json
 import time
 from pathlib import Path
 from prometheus_client import Counter, Histogram, Gauge, make_asgi_app
 from prometheus_fastapi_instrumentator import Instrumentator
+from fetch_model import cached_artifact_is_current, download_run_artifacts, run_id_sidecar, write_run_id_sidecar
+from rf_inference import extract_tree_arrays, load_tree_arrays, predict_trees, save_tree_arrays
 
-app = FastAPI(title="Exchange Rate Forecast API", version="1.0.0")
+# orjson (already a requirement for the DAG) serializes responses much faster than the stdlib encoder
+app = FastAPI(title="Exchange Rate Forecast API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # Prometheus metrics
 # Service metrics
@@ -19,6 +28,14 @@ http_request_count = Counter(
     ['method', 'endpoint', 'status']
 )
 
+# Label children bound once instead of resolving labels on every request (each route has a single method)
+requests_home_200 = http_request_count.labels(method="GET", endpoint="/", status=200)
+requests_health_200 = http_request_count.labels(method="GET", endpoint="/health", status=200)
+requests_health_503 = http_request_count.labels(method="GET", endpoint="/health", status=503)
+requests_predict_200 = http_request_count.labels(method="POST", endpoint="/predict", status=200)
+requests_predict_500 = http_request_count.labels(method="POST", endpoint="/predict", status=500)
+requests_predict_503 = http_request_count.labels(method="POST", endpoint="/predict", status=503)
+
 inference_latency = Histogram(
     'inference_latency_seconds',
     'Inference latency in seconds',
@@ -54,12 +71,78 @@ os.environ['MLFLOW_TRACKING_PASSWORD'] = os.getenv('DAGSHUB_TOKEN', os.getenv('M
 
 # Model loading logic
 MODEL_PATH = os.getenv("MODEL_PATH", "/app/models/rf_model.pkl")
+# Tree-only arrays of the same model (see rf_inference.py); much faster to load than the pickle
+MODEL_NPZ_PATH = os.getenv("MODEL_NPZ_PATH", str(Path(MODEL_PATH).with_suffix(".npz")))
 RUN_ID = os.getenv("MLFLOW_RUN_ID", None)
 TRAINING_STATS_PATH = os.getenv("TRAINING_STATS_PATH", "/app/models/training_stats.json")
 
 # Training data statistics for drift detection
 training_stats = None
 
+# Per-feature drift bounds from training_stats, indexed like the model input (see load_drift_bounds)
+_MEANS = _STDS = _MINS = _MAXS = None
+
+# Stacked tree arrays of the loaded forest, used by predict_trees instead of model.predict
+forest = None
+
+# Number of lag features the model expects
+N_LAGS = 3
+
+# /predict micro-batching: at most PREDICT_MAX_BATCH queued requests per kernel call, optionally
+# waiting PREDICT_BATCH_WAIT_MS for more to arrive (0 = only batch requests that are already queued)
+PREDICT_MAX_BATCH = int(os.getenv("PREDICT_MAX_BATCH", "64"))
+PREDICT_BATCH_WAIT_MS = float(os.getenv("PREDICT_BATCH_WAIT_MS", "0"))
+
+class PredictionBatcher:
+    """
+    Coalesce concurrent /predict calls into one predict_trees call per batch.
+
+    Runs as a task on the event loop, so the preallocated input buffer needs no locking.
+    A batch is whatever is queued when the task wakes up; the kernel costs microseconds
+    per row, so waiting for more requests is opt-in via PREDICT_BATCH_WAIT_MS.
+    """
+
+    def __init__(self, max_batch=PREDICT_MAX_BATCH, wait_ms=PREDICT_BATCH_WAIT_MS):
+        self.max_batch = max_batch
+        self.wait = wait_ms / 1000
+        self.queue = asyncio.Queue()
+        self.buffer = np.empty((max_batch, N_LAGS), dtype=np.float32)
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def predict(self, values):
+        """Queue one row of lag values and wait for its prediction."""
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((values, future))
+        return await future
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            if self.wait > 0:
+                await asyncio.sleep(self.wait)
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            try:
+                for i, (values, _) in enumerate(batch):
+                    self.buffer[i, :] = values
+                predictions = predict_trees(self.buffer[:len(batch)], forest)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            # Requests cancelled in the meantime (client disconnects) already have a done future
+            for (_, future), prediction in zip(batch, predictions):
+                if not future.done():
+                    future.set_result(float(prediction))
+
+batcher = PredictionBatcher()
+
 def load_training_stats():
     """Load training data statistics for drift detection."""
     global training_stats
@@ -67,6 +150,7 @@ def load_training_stats():
         if Path(TRAINING_STATS_PATH).exists():
             with open(TRAINING_STATS_PATH, 'r') as f:
                 training_stats = json.load(f)
+            load_drift_bounds()
             print(f"✓ Training statistics loaded from {TRAINING_STATS_PATH}")
         else:
             print(f"⚠ Warning: Training statistics not found at {TRAINING_STATS_PATH}")
@@ -75,46 +159,136 @@ def load_training_stats():
         print(f"⚠ Error loading training statistics: {str(e)}")
         training_stats = None
 
+def load_drift_bounds():
+    """
+    Turn training_stats into arrays so check_data_drift is a single vectorized comparison.
+    Features missing from the statistics get bounds that never flag drift, and a zero
+    std disables the z-score test for that feature.
+    """
+    global _MEANS, _STDS, _MINS, _MAXS
+    features = training_stats.get('features', {})
+    
+    means = np.zeros(N_LAGS)
+    stds = np.full(N_LAGS, np.inf)
+    mins = np.full(N_LAGS, -np.inf)
+    maxs = np.full(N_LAGS, np.inf)
+    for i in range(N_LAGS):
+        stats = features.get(f"lag_{i+1}")
+        if stats is None:
+            continue
+        means[i] = stats['mean']
+        stds[i] = stats['std'] if stats['std'] > 0 else np.inf
+        mins[i] = stats['min']
+        maxs[i] = stats['max']
+    
+    _MEANS, _STDS, _MINS, _MAXS = means, stds, mins, maxs
+
 def check_data_drift(feature_values):
     """
     Check if feature values are out-of-distribution.
-    Returns True if any feature is outside 3 standard deviations from training mean.
+    Returns True if any feature is outside the training range or more than
+    3 standard deviations from the training mean.
     """
-    if training_stats is None or 'features' not in training_stats:
+    if _MEANS is None:
         return False
     
-    for i, value in enumerate(feature_values):
-        feature_name = f"lag_{i+1}"
-        if feature_name not in training_stats['features']:
-            continue
-        
-        stats = training_stats['features'][feature_name]
-        mean = stats['mean']
-        std = stats['std']
-        min_val = stats['min']
-        max_val = stats['max']
-        
-        # Check if value is outside training range (with some tolerance)
-        # Also check if value is more than 3 standard deviations from mean
-        z_score = abs((value - mean) / std) if std > 0 else 0
-        out_of_range = value < min_val or value > max_val
-        
-        if out_of_range or z_score > 3:
-            return True
+    v = np.asarray(feature_values, dtype=np.float64)
+    out_of_range = (v < _MINS) | (v > _MAXS)
+    return bool((out_of_range | (np.abs((v - _MEANS) / _STDS) > 3)).any())
+
+def model_source():
+    """
+    Identify the model at MODEL_PATH: the MLflow run recorded in its sidecar, or the
+    size and mtime of a pickle of unknown origin. None if there is no local model.
+    """
+    sidecar = run_id_sidecar(MODEL_PATH)
+    if sidecar.exists():
+        return sidecar.read_text().strip()
+    if Path(MODEL_PATH).exists():
+        stat = Path(MODEL_PATH).stat()
+        return f"local:{stat.st_size}:{stat.st_mtime_ns}"
+    return None
+
+def use_tree_arrays_cache():
+    """
+    Whether MODEL_NPZ_PATH holds the tree arrays of the current model.
+
+    The .npz sidecar names the model it belongs to and must match MLFLOW_RUN_ID, or
+    without it the model at MODEL_PATH. File mtimes are not compared: downloaded
+    artifacts keep the timestamps of the artifact store's copies.
+    """
+    sidecar = run_id_sidecar(MODEL_NPZ_PATH)
+    if not Path(MODEL_NPZ_PATH).exists() or not sidecar.exists():
+        return False
+    expected = RUN_ID or model_source()
+    return expected is None or sidecar.read_text().strip() == expected
+
+def load_cached_tree_arrays():
+    """Load the tree arrays from MODEL_NPZ_PATH if they belong to the current model, else None."""
+    if not use_tree_arrays_cache():
+        return None
     
-    return False
+    print(f"Loading tree arrays from: {MODEL_NPZ_PATH}")
+    try:
+        arrays = load_tree_arrays(MODEL_NPZ_PATH)
+        print("Model loaded successfully from tree arrays!")
+        return arrays
+    except Exception as e:
+        print(f"Error loading tree arrays: {str(e)}")
+        return None
+
+def cache_tree_arrays(sklearn_model):
+    """Extract the tree arrays from a fitted forest, cache them at MODEL_NPZ_PATH and return them."""
+    arrays = extract_tree_arrays(sklearn_model)
+    try:
+        Path(MODEL_NPZ_PATH).parent.mkdir(parents=True, exist_ok=True)
+        sidecar = run_id_sidecar(MODEL_NPZ_PATH)
+        sidecar.unlink(missing_ok=True)
+        save_tree_arrays(MODEL_NPZ_PATH, arrays)
+        source = model_source()
+        if source is not None:
+            write_run_id_sidecar(MODEL_NPZ_PATH, source)
+        print(f"✓ Tree arrays cached to {MODEL_NPZ_PATH}")
+    except Exception as e:
+        print(f"⚠ Could not cache tree arrays: {str(e)}")
+    return arrays
+
+def fetch_run_model(run_id, extra_artifacts=None):
+    """
+    Download rf_model.pkl and rf_model.npz of an MLflow run to MODEL_PATH and MODEL_NPZ_PATH
+    (plus extra_artifacts, a dict of artifact path -> local path) and return the model's tree
+    arrays, preferring the .npz. Runs logged without rf_model.npz fall back to the pickle.
+    """
+    output_paths = {"rf_model.pkl": MODEL_PATH, "rf_model.npz": MODEL_NPZ_PATH, **(extra_artifacts or {})}
+    local_paths = download_run_artifacts(run_id, list(output_paths), Path(MODEL_PATH).parent,
+                                         output_paths=output_paths)
+    if "rf_model.pkl" not in local_paths:
+        raise FileNotFoundError(f"Run {run_id} has no artifact rf_model.pkl")
+    
+    arrays = load_cached_tree_arrays()
+    if arrays is None:
+        arrays = cache_tree_arrays(joblib.load(MODEL_PATH, mmap_mode='r'))
+    return arrays
 
 def load_model():
-    """Load model from local path or MLflow."""
-    global model
+    """Load the model's tree arrays from the tree-array cache, local path or MLflow."""
+    # Fastest path: numeric tree arrays only, no unpickling of 200 sklearn estimators
+    arrays = load_cached_tree_arrays()
+    if arrays is not None:
+        return arrays
+    
+    # With MLFLOW_RUN_ID set, a local model downloaded from another run (or of unknown origin) is stale
+    local_is_current = not RUN_ID or cached_artifact_is_current(MODEL_PATH, RUN_ID, "rf_model.pkl")
+    if not local_is_current:
+        print(f"Local model is not from MLflow run {RUN_ID}, it will be downloaded")
     
     # Try to load from local path first (for Docker deployment)
-    if Path(MODEL_PATH).exists():
+    if local_is_current and Path(MODEL_PATH).exists():
         print(f"Loading model from local path: {MODEL_PATH}")
         try:
-            model = joblib.load(MODEL_PATH)
+            arrays = cache_tree_arrays(joblib.load(MODEL_PATH, mmap_mode='r'))
             print("Model loaded successfully from local path!")
-            return
+            return arrays
         except Exception as e:
             print(f"Error loading from local path: {str(e)}")
     
@@ -122,81 +296,113 @@ def load_model():
     if RUN_ID:
         print(f"Loading model from MLflow run: {RUN_ID}")
         try:
-            MODEL_URI = f"runs:/{RUN_ID}/rf_model.pkl"
-            local_path = mlflow.artifacts.download_artifacts(artifact_uri=MODEL_URI)
-            model = joblib.load(local_path)
-            
-            # Save to MODEL_PATH for future use
-            Path(MODEL_PATH).parent.mkdir(parents=True, exist_ok=True)
-            import shutil
-            shutil.copy2(local_path, MODEL_PATH)
+            arrays = fetch_run_model(RUN_ID)
             print(f"Model loaded from MLflow and saved to {MODEL_PATH}")
-            return
+            return arrays
         except Exception as e:
             print(f"Error loading from MLflow: {str(e)}")
     
     # Last resort: try to fetch best model automatically
     print("Attempting to fetch best model from MLflow...")
     try:
-        from fetch_model import get_best_model_run_id, download_model
+        from fetch_model import get_best_model_run_id
         best_run_id, metric_value = get_best_model_run_id()
-        model_path = download_model(best_run_id, output_dir="/app/models")
-        model = joblib.load(model_path)
+        arrays = fetch_run_model(best_run_id, extra_artifacts={"training_stats.json": TRAINING_STATS_PATH})
         print(f"Successfully loaded best model (RMSE: {metric_value})")
-        return
+        return arrays
     except Exception as e:
         print(f"Error fetching best model: {str(e)}")
     
     raise RuntimeError("Model not found! Please ensure MODEL_PATH or MLFLOW_RUN_ID is set correctly.")
 
-# Load model and training statistics at startup
-try:
-    load_model()
-    load_training_stats()
-except Exception as e:
-    print(f"Failed to load model: {str(e)}")
-    model = None
-
-class History(BaseModel):
-    history: list
+# Probe responses are encoded once per state change rather than on every request
+HEALTH_OK_BODY = orjson.dumps({"status": "healthy", "model_loaded": True})
+home_body = None
 
-@app.get("/")
-def home(request: Request):
-    """Health check endpoint."""
-    http_request_count.labels(method=request.method, endpoint="/", status=200).inc()
-    return {
+def refresh_home_body():
+    """Re-encode the / response after the model or training statistics change."""
+    global home_body
+    home_body = orjson.dumps({
         "message": "Exchange Rate Forecast API Running",
         "status": "healthy",
-        "model_loaded": model is not None,
+        "model_loaded": forest is not None,
         "monitoring": {
             "prometheus": "/metrics",
             "drift_detection": training_stats is not None
         }
-    }
+    })
+
+refresh_home_body()
+
+def load_artifacts():
+    """
+    Load model and training statistics (blocking: network, disk and JIT compilation).
+
+    The global forest is only assigned once everything is ready, since /health and
+    /predict treat it as the readiness signal.
+    """
+    global forest
+    try:
+        arrays = load_model()
+        predict_trees(np.zeros((1, N_LAGS)), arrays)  # compile the kernel before the first request
+        load_training_stats()
+        forest = arrays
+    except Exception as e:
+        print(f"Failed to load model: {str(e)}")
+        forest = None
+    finally:
+        refresh_home_body()
+
+@app.on_event("startup")
+async def start_loading_artifacts():
+    """
+    Load the model in a worker thread without awaiting it, so the server starts accepting
+    connections immediately; /health and /predict answer 503 until the model is ready.
+    """
+    loop = asyncio.get_running_loop()
+    app.state.artifacts_loading = loop.run_in_executor(None, load_artifacts)
+    batcher.start()
+
+class History(BaseModel):
+    # Shorter histories are rejected during parsing; only the most recent N_LAGS values are kept
+    history: conlist(float, min_length=N_LAGS)
+
+    @field_validator('history')
+    @classmethod
+    def keep_recent_lags(cls, v):
+        return v[-N_LAGS:]
+
+@app.exception_handler(RequestValidationError)
+async def validation_exception_handler(request: Request, exc: RequestValidationError):
+    """Count rejected request bodies, then return FastAPI's default 422 response."""
+    http_request_count.labels(method=request.method, endpoint=request.url.path, status=422).inc()
+    return await request_validation_exception_handler(request, exc)
+
+@app.get("/")
+async def home():
+    """Health check endpoint."""
+    requests_home_200.inc()
+    return Response(content=home_body, media_type="application/json")
 
 @app.get("/health")
-def health(request: Request):
+async def health():
     """Health check endpoint for Docker."""
-    if model is None:
-        http_request_count.labels(method=request.method, endpoint="/health", status=503).inc()
+    if forest is None:
+        requests_health_503.inc()
         raise HTTPException(status_code=503, detail="Model not loaded")
-    http_request_count.labels(method=request.method, endpoint="/health", status=200).inc()
-    return {"status": "healthy", "model_loaded": True}
+    requests_health_200.inc()
+    return Response(content=HEALTH_OK_BODY, media_type="application/json")
 
 @app.post("/predict")
-def predict(data: History, request: Request):
+async def predict(data: History):
     """Predict exchange rate based on historical values."""
     start_time = time.time()
     
-    if model is None:
-        http_request_count.labels(method=request.method, endpoint="/predict", status=503).inc()
+    if forest is None:
+        requests_predict_503.inc()
         raise HTTPException(status_code=503, detail="Model not loaded")
     
-    if len(data.history) < 3:
-        http_request_count.labels(method=request.method, endpoint="/predict", status=400).inc()
-        raise HTTPException(status_code=400, detail="Need at least 3 historical values")
-    
-    values = data.history[-3:]  # Use recent 3 values as lags
+    values = data.history  # Recent 3 values as lags, already trimmed by History
     
     # Check for data drift
     is_drift = check_data_drift(values)
@@ -213,15 +419,14 @@ def predict(data: History, request: Request):
     # We'll update it here for convenience, but Grafana dashboard uses PromQL for accuracy
     
     try:
-        pred = model.predict([values])
-        prediction_value = float(pred[0])
+        prediction_value = await batcher.predict(values)
         
         # Record inference latency
         latency = time.time() - start_time
         inference_latency.observe(latency)
         
         # Record successful request
-        http_request_count.labels(method=request.method, endpoint="/predict", status=200).inc()
+        requests_predict_200.inc()
         
         return {
             "prediction": prediction_value,
@@ -229,5 +434,5 @@ def predict(data: History, request: Request):
             "latency_ms": round(latency * 1000, 2)
         }
     except Exception as e:
-        http_request_count.labels(method=request.method, endpoint="/predict", status=500).inc()
+        requests_predict_500.inc()
         raise HTTPException(status_code=500, detail=f"Prediction error: {str(e)}")
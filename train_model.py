@@ -1,4 +1,6 @@
 import os
+import itertools
+import numpy as np
 import pandas as pd
 from datetime import datetime
 from sklearn.model_selection import train_test_split
@@ -8,35 +10,37 @@ import mlflow
 import joblib
 import json
 from pathlib import Path
+from fetch_model import invalidate_best_run_cache
+from rf_inference import extract_tree_arrays, save_tree_arrays
 
-DATA_PATH = "data/processed/exchange_rates.csv"
+DATA_PATH = "data/processed/exchange_rates.parquet"
 TARGET_COL = "EUR"
 TIMESTAMP_COL = "collection_datetime"
 
+# Random forest hyperparameter grid searched on every training run. The previous fixed
+# settings are the baseline; the smallest forest within RMSE_TOLERANCE of its RMSE wins.
+# Candidates are scored on the last VALIDATION_SIZE of the training split, never on the test split.
+PARAM_GRID = {
+    "n_estimators": [50, 100, 200],
+    "max_depth": [5, 8, 10],
+    "min_samples_leaf": [1, 5],
+}
+BASELINE_PARAMS = {"n_estimators": 200, "max_depth": 10, "min_samples_leaf": 1}
+RMSE_TOLERANCE = 0.01
+VALIDATION_SIZE = 0.2
+
 def load_data():
-    # Read CSV and handle potential parsing errors
+    # Read only the columns we need from the partitioned Parquet dataset written by the Airflow DAG
+    # (timestamps are stored typed, so there is no separate datetime parsing pass)
     try:
-        df = pd.read_csv(DATA_PATH, on_bad_lines='skip')
-    except TypeError:
-        # Fallback for older pandas versions
-        df = pd.read_csv(DATA_PATH, error_bad_lines=False, warn_bad_lines=False)
+        df = pd.read_parquet(DATA_PATH, engine="pyarrow", columns=[TIMESTAMP_COL, TARGET_COL])
+    except ValueError as e:  # pyarrow.lib.ArrowInvalid, e.g. a missing column
+        raise ValueError(f"Could not read columns {[TIMESTAMP_COL, TARGET_COL]} from {DATA_PATH}: {str(e)}")
     
     if df.empty:
         raise ValueError(f"Data file {DATA_PATH} is empty. Please run the Airflow DAG to collect data first.")
     
-    # Select only the columns we need
-    required_cols = [TIMESTAMP_COL, TARGET_COL]
-    available_cols = [col for col in required_cols if col in df.columns]
-    
-    # Check if required columns exist
-    if TARGET_COL not in df.columns:
-        raise ValueError(f"Target column '{TARGET_COL}' not found in data. Available columns: {list(df.columns)}")
-    
-    # Keep only essential columns
-    essential_cols = [TIMESTAMP_COL, TARGET_COL]
-    df = df[[col for col in essential_cols if col in df.columns]]
-    
-    df[TIMESTAMP_COL] = pd.to_datetime(df[TIMESTAMP_COL], errors='coerce')
+    df[TARGET_COL] = df[TARGET_COL].astype("float32")
     df = df.dropna(subset=[TIMESTAMP_COL, TARGET_COL])
     df = df.sort_values(TIMESTAMP_COL)
     
@@ -59,24 +63,54 @@ def create_lags(df, n_lags=3):
             f"Please run the Airflow DAG multiple times to collect more data, or reduce n_lags."
         )
     
-    # Create lag features
-    for lag in range(1, n_lags + 1):
-        df[f"lag_{lag}"] = df[TARGET_COL].shift(lag)
-    
-    # Drop rows with NaN (first n_lags rows will have NaN in lag columns)
-    df = df.dropna()
+    # Create lag features from sliding windows over the target (no NaN rows to drop):
+    # row i holds [t-n_lags, ..., t-1, t], reversed so that lag_1 comes first
+    values = df[TARGET_COL].to_numpy()
+    windows = np.lib.stride_tricks.sliding_window_view(values, n_lags + 1)
     
-    if len(df) == 0:
-        raise ValueError(
-            f"After creating lag features, no valid data remains. "
-            f"This should not happen if you have at least {min_required_rows} rows."
-        )
-    
-    X = df[[f"lag_{i}" for i in range(1, n_lags + 1)]]
-    y = df[TARGET_COL]
+    X = pd.DataFrame(
+        windows[:, -2::-1],
+        columns=[f"lag_{i}" for i in range(1, n_lags + 1)],
+        index=df.index[n_lags:]
+    )
+    y = df[TARGET_COL].iloc[n_lags:]
     
     return X, y
 
+def select_model(X_fit, y_fit, X_val, y_val):
+    """
+    Fit every PARAM_GRID combination and pick the cheapest forest whose validation RMSE
+    is within RMSE_TOLERANCE of the baseline. Size is the total node count, which drives
+    both artifact size and /predict latency. Each candidate is logged as a nested MLflow
+    run under its own metric names, so fetch_model only ranks the selected models.
+    
+    Returns the selected params, their validation RMSE and the baseline validation RMSE.
+    """
+    candidates = []
+    for values in itertools.product(*PARAM_GRID.values()):
+        params = dict(zip(PARAM_GRID.keys(), values))
+        model = RandomForestRegressor(**params, random_state=42)
+        model.fit(X_fit, y_fit)
+        
+        rmse = mean_squared_error(y_val, model.predict(X_val)) ** 0.5
+        n_nodes = sum(estimator.tree_.node_count for estimator in model.estimators_)
+        candidates.append((model, params, rmse, n_nodes))
+        
+        run_name = "rf_grid_{n_estimators}_{max_depth}_{min_samples_leaf}".format(**params)
+        with mlflow.start_run(run_name=run_name, nested=True):
+            mlflow.log_params(params)
+            mlflow.log_metric("candidate_val_rmse", rmse)
+            mlflow.log_metric("candidate_nodes", n_nodes)
+    
+    baseline_rmse = next(rmse for _, params, rmse, _ in candidates if params == BASELINE_PARAMS)
+    eligible = [c for c in candidates if c[2] <= baseline_rmse * (1 + RMSE_TOLERANCE)]
+    _, params, rmse, n_nodes = min(eligible, key=lambda c: (c[3], c[2]))
+    
+    print(f"✓ Searched {len(candidates)} configurations, {len(eligible)} within "
+          f"{RMSE_TOLERANCE:.0%} of baseline validation RMSE {baseline_rmse:.4f}")
+    print(f"✓ Selected {params} ({n_nodes} nodes, validation RMSE {rmse:.4f})")
+    return params, rmse, baseline_rmse
+
 def train():
     # Set MLflow tracking URI
     tracking_uri = os.getenv("MLFLOW_TRACKING_URI", "https://dagshub.com/hamnariaz57/Mlops_Project.mlflow")
@@ -109,8 +143,18 @@ def train():
     else:
         X_train, X_test, y_train, y_test = train_test_split(X, y, shuffle=False, test_size=0.2)
 
+    # Hyperparameters are chosen on a validation split carved from the end of the training
+    # data, so the test RMSE logged below stays comparable with other runs
+    if len(X_train) < 10:
+        X_fit, X_val, y_fit, y_val = X_train, X_train, y_train, y_train
+    else:
+        X_fit, X_val, y_fit, y_val = train_test_split(X_train, y_train, shuffle=False, test_size=VALIDATION_SIZE)
+
     with mlflow.start_run(run_name="rf_exchange_rate"):
-        model = RandomForestRegressor(n_estimators=200, max_depth=10, random_state=42)
+        params, val_rmse, baseline_val_rmse = select_model(X_fit, y_fit, X_val, y_val)
+
+        # Refit the selected configuration on the full training split
+        model = RandomForestRegressor(**params, random_state=42)
         model.fit(X_train, y_train)
 
         y_pred = model.predict(X_test)
@@ -124,26 +168,27 @@ def train():
         mlflow.log_metric("rmse", rmse)
         mlflow.log_metric("mae", mae)
         mlflow.log_metric("r2", r2)
+        mlflow.log_metric("val_rmse", val_rmse)
+        mlflow.log_metric("baseline_val_rmse", baseline_val_rmse)
 
-        mlflow.log_params({"n_estimators": 200, "max_depth": 10})
+        mlflow.log_params(params)
 
-        # Save locally + upload as artifact
+        # Save locally + upload as artifact (uncompressed, so the service can memory-map its arrays)
         model_path = "rf_model.pkl"
         joblib.dump(model, model_path)
         mlflow.log_artifact(model_path)
 
+        # Tree-only arrays for the service: loads without unpickling the sklearn estimators
+        tree_arrays_path = "rf_model.npz"
+        save_tree_arrays(tree_arrays_path, extract_tree_arrays(model))
+        mlflow.log_artifact(tree_arrays_path)
+
         # Save training data statistics for drift detection
+        stats_df = X_train.agg(["min", "max", "mean", "std"]).astype(float)
         training_stats = {
-            "features": {},
+            "features": {col: stats_df[col].to_dict() for col in X_train.columns},
             "timestamp": datetime.now().isoformat()
         }
-        for col in X_train.columns:
-            training_stats["features"][col] = {
-                "min": float(X_train[col].min()),
-                "max": float(X_train[col].max()),
-                "mean": float(X_train[col].mean()),
-                "std": float(X_train[col].std())
-            }
         
         stats_path = "training_stats.json"
         with open(stats_path, 'w') as f:
@@ -164,5 +209,8 @@ def train():
         print(f"RMSE: {rmse:.4f}, MAE: {mae:.4f}, R2: {r2:.4f}")
         print(f"✓ Training statistics saved for drift detection")
 
+    # The new run may be the new best model, so drop any cached best-run lookup
+    invalidate_best_run_cache()
+
 if __name__ == "__main__":
     train()